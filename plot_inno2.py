@@ -2,11 +2,40 @@ import tkinter as tk
 from tkinter import messagebox, ttk
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from datetime import datetime
 import threading
-import time
-from astropy.io import fits
+import queue
+import fitsio
+import h5py
+import pyfftw
+from numba import njit
+
+
+@njit(cache=True, nogil=True)
+def push_sample(ring, row_min, row_max, avg_sum, index, avg_steps, sample, ydec):
+    """Store sample at ring[index], record the extrema of its ydec-bin block maxima and slide the running avg_steps-row column sum forward."""
+    oldest = (index - avg_steps) % ring.shape[0]
+    for j in range(sample.shape[0]):
+        avg_sum[j] += sample[j] - ring[oldest, j]
+        ring[index, j] = sample[j]
+    # Extrema of the row as decimate() draws it, so the colour limits match the image
+    lo = np.inf
+    hi = -np.inf
+    for b in range(sample.shape[0] // ydec):
+        peak = sample[b * ydec]
+        for j in range(b * ydec + 1, (b + 1) * ydec):
+            peak = max(peak, sample[j])
+        lo = min(lo, peak)
+        hi = max(hi, peak)
+    row_min[index] = lo
+    row_max[index] = hi
+
+
+# Colour map names for the combobox, read from matplotlib's registry once
+CMAPS = plt.colormaps()
 
 
 class SpectrogramApp:
@@ -35,9 +64,11 @@ class SpectrogramApp:
 
         tk.Label(root, text="Color Map:").grid(row=0, column=2, sticky="ew", padx=5, pady=5)
         self.cmap_var = tk.StringVar(value='viridis')
-        self.cmap_combo = ttk.Combobox(root, textvariable=self.cmap_var, values=plt.colormaps())
+        self.cmap = plt.get_cmap(self.cmap_var.get())
+        # Read-only: names can only come from the list, so change_cmap never sees an unknown one
+        self.cmap_combo = ttk.Combobox(root, textvariable=self.cmap_var, values=CMAPS, state="readonly")
         self.cmap_combo.grid(row=0, column=3, padx=5, pady=5)
-        self.cmap_combo.bind("<<ComboboxSelected>>", lambda e: self.update_plot())
+        self.cmap_combo.bind("<<ComboboxSelected>>", self.change_cmap)
 
         # Plot and toolbar frame
         plot_frame = tk.Frame(root)
@@ -56,15 +87,38 @@ class SpectrogramApp:
         for i in range(4):
             root.grid_columnconfigure(i, weight=1)
 
+        # Off-screen figure reused for every PNG snapshot, kept away from pyplot
+        self.save_fig = Figure(figsize=(12, 5))
+        self.save_canvas = FigureCanvasAgg(self.save_fig)
+
+        # RICE quantization of the FITS DATA HDU: each tile (one spectrum) is
+        # quantized in steps of its noise sigma / fits_qlevel. At 16 the RMS error
+        # is under 1% of the data's spread (about 3.5% at cfitsio's default of 4).
+        # SUBTRACTIVE_DITHER_2 dithers the steps but keeps exact zeros.
+        self.fits_qlevel = 16.0
+        self.fits_qmethod = 'SUBTRACTIVE_DITHER_2'
+
+        # Disk writes run on their own thread; save_outputs only snapshots
+        self.write_queue = queue.Queue(maxsize=2)
+        self.writer_thread = threading.Thread(target=self.write_worker, daemon=True)
+        self.writer_thread.start()
+
+        self.im = None
+        self.after_id = None
         self.colorbar = None
+        self.plot_rows = 800
         self.running = False
-        self.lock = threading.Lock()
 
         self.live_duration = 10
         self.save_duration = 60
         self.avg_duration = 30
+        # HDF5 appends run at least this often; generate_data also wakes auto_save
+        # once half the save window is waiting to be streamed
+        self.stream_interval = self.save_duration / 2
         self.data_interval = 0.02
         self.update_interval = 100
+        self.batch_size = 256
+        self.rng = np.random.default_rng()
 
         self.avg_label = tk.Label(root, text="Avg Frequency (30s): --- Hz")
         self.avg_label.grid(row=1, column=2, columnspan=2, sticky="ew", padx=5, pady=5)
@@ -78,143 +132,284 @@ class SpectrogramApp:
             messagebox.showerror("Invalid Input", "Please enter positive integers for Fs and N.")
             return
 
-        self.freqs = np.linspace(0, self.fs / 2, self.n)
+        # Each sample is the rfft of N simulated points: N // 2 + 1 bins from 0 to Fs/2
+        self.nbins = self.n // 2 + 1
+        self.freqs = np.fft.rfftfreq(self.n, d=1 / self.fs).astype(np.float32)
         self.running = True
 
         self.live_steps = int(self.live_duration / self.data_interval)
         self.save_steps = int(self.save_duration / self.data_interval)
         self.avg_steps = int(self.avg_duration / self.data_interval)
 
-        self.live_buffer = np.zeros((self.live_steps, self.n))
-        self.save_buffer = np.zeros((self.save_steps, self.n))
-        self.avg_buffer = np.zeros((self.avg_steps, self.n))
-
-        self.live_index = self.save_index = self.avg_index = 0
+        # One ring holds the 60s save window; the live and avg windows are its tail.
+        # A 1s margin of spare rows keeps the producer clear of a full-window read.
+        self.ring_steps = self.save_steps + int(1 / self.data_interval)
+        self.save_buffer = np.zeros((self.ring_steps, self.nbins), dtype=np.float32)
+        self.save_index = 0
+        self.samples_written = 0
+        # Samples already appended to the HDF5 stream
+        self.stream_rows = 0
+        # Running column sum of the newest avg_steps rows, for the avg label
+        self.avg_sum = np.zeros(self.nbins, dtype=np.float64)
+        # Per-row extrema of save_buffer as displayed, so the colour limits need no full scan
+        self.row_min = np.zeros(self.ring_steps, dtype=np.float32)
+        self.row_max = np.zeros(self.ring_steps, dtype=np.float32)
+
+        # Frequency bins folded into each displayed row
+        self.ydec = max(1, self.nbins // self.plot_rows)
+        self.setup_plot()
 
         self.start_button.config(state=tk.DISABLED)
         self.stop_button.config(state=tk.NORMAL)
 
-        threading.Thread(target=self.generate_data, daemon=True).start()
-        threading.Thread(target=self.auto_save, daemon=True).start()
+        # Each run gets its own stop event and buffers, so a producer still
+        # planning its FFT when this run is stopped can only touch its own
+        self.stop_event = threading.Event()
+        self.stream_event = threading.Event()
+        self.data_thread = threading.Thread(
+            target=self.generate_data,
+            args=(self.stop_event, self.n, self.ydec, self.save_buffer, self.row_min, self.row_max, self.avg_sum),
+            daemon=True)
+        self.data_thread.start()
+        self.save_thread = threading.Thread(target=self.auto_save, daemon=True)
+        self.save_thread.start()
         self.update_plot()
 
-    def generate_data(self):
-        while self.running:
-            new_sample = np.random.rand(self.n) * 100
-
-            with self.lock:
-                self.live_buffer[self.live_index, :] = new_sample
-                self.live_index = (self.live_index + 1) % self.live_steps
-
-                self.save_buffer[self.save_index, :] = new_sample
-                self.save_index = (self.save_index + 1) % self.save_steps
-
-                self.avg_buffer[self.avg_index, :] = new_sample
-                self.avg_index = (self.avg_index + 1) % self.avg_steps
-
-            time.sleep(self.data_interval)
-
-    def update_plot(self):
-        if not self.running:
-            return
-
-        with self.lock:
-            if np.all(self.live_buffer == 0):
-                self.root.after(self.update_interval, self.update_plot)
-                return
-
-            if self.live_index == 0:
-                data_to_plot = self.live_buffer.copy()
-            else:
-                data_to_plot = np.vstack((self.live_buffer[self.live_index:, :], self.live_buffer[:self.live_index, :]))
-
-        extent = [-self.live_duration, 0, 0, self.fs / 2]
+    def decimate(self, data):
+        """Block-max the frequency axis down to about plot_rows bins, keeping peaks visible."""
+        if self.ydec == 1:
+            return data
+        rows = self.nbins // self.ydec
+        return data[:, :rows * self.ydec].reshape(len(data), rows, self.ydec).max(axis=-1)
+
+    def setup_plot(self):
+        # Create the image and colorbar once; update_plot only swaps pixel data.
+        # decimate() drops the top nbins % ydec bins, so the image ends just below Fs/2
+        rows = self.nbins // self.ydec
+        top = self.fs / 2 * rows * self.ydec / self.nbins
+        extent = [-self.live_duration, 0, 0, top]
         self.ax.clear()
-        im = self.ax.imshow(
-            data_to_plot.T,
+        self.im = self.ax.imshow(
+            np.zeros((rows, self.live_steps), dtype=np.float32),
             aspect='auto',
             extent=extent,
             origin='lower',
-            cmap=self.cmap_var.get(),
+            cmap=self.cmap,
             interpolation='nearest'
         )
         self.ax.set_title("Live Spectrogram (Last 10s)")
         self.ax.set_xlabel("Time (s)")
         self.ax.set_ylabel("Frequency (Hz)")
         self.ax.set_xlim(-self.live_duration, 0)
-        self.ax.set_ylim(0, self.fs / 2)
+        self.ax.set_ylim(0, top)
 
         if self.colorbar is None:
-            self.colorbar = self.fig.colorbar(im, ax=self.ax, label="Intensity")
+            self.colorbar = self.fig.colorbar(self.im, ax=self.ax, label="Intensity")
         else:
-            im.set_clim(vmin=np.min(data_to_plot), vmax=np.max(data_to_plot))
-            self.colorbar.update_normal(im)
+            self.colorbar.update_normal(self.im)
+        self.canvas.draw_idle()
 
-        self.canvas.draw()
+    def change_cmap(self, event=None):
+        # Resolve the Colormap once here so nothing else reads cmap_var
+        self.cmap = plt.get_cmap(self.cmap_var.get())
+        if self.im is None:
+            return
+        self.im.set_cmap(self.cmap)
+        self.canvas.draw_idle()
+
+    def generate_data(self, stop_event, n, ydec, save_buffer, row_min, row_max, avg_sum):
+        # Simulate a batch of noise signals, take their magnitude spectra with one
+        # reused rfft plan, and hand the spectra out row by row. FFTW_MEASURE
+        # planning is paid once here, off the Tk thread.
+        ring_steps, nbins = save_buffer.shape
+        signal = pyfftw.empty_aligned((self.batch_size, n), dtype='float32')
+        spectrum = pyfftw.empty_aligned((self.batch_size, nbins), dtype='complex64')
+        rfft = pyfftw.FFTW(signal, spectrum, axes=(-1,), flags=('FFTW_MEASURE',))
+        batch = np.empty((self.batch_size, nbins), dtype=np.float32)
+        batch_index = self.batch_size
+        index = 0
+        while not stop_event.is_set():
+            if batch_index == self.batch_size:
+                self.rng.standard_normal(dtype=np.float32, out=signal)
+                rfft()
+                np.abs(spectrum, out=batch)
+                batch_index = 0
+            new_sample = batch[batch_index]
+            batch_index += 1
+
+            # Single producer: store the row first, then publish the new index.
+            # The row leaving the avg window is still in save_buffer.
+            push_sample(save_buffer, row_min, row_max, avg_sum, index, self.avg_steps, new_sample, ydec)
+            index = (index + 1) % ring_steps
+            self.save_index = index
+            self.samples_written += 1
+            # Wake auto_save well before unstreamed rows are overwritten
+            if self.samples_written - self.stream_rows >= self.save_steps // 2:
+                self.stream_event.set()
+
+            stop_event.wait(self.data_interval)
+
+    def tail(self, rows, index=None):
+        """Return the `rows` samples of save_buffer ending before `index` (default: newest), oldest first.
+
+        save_index is only advanced by generate_data after the row is stored, so
+        reading it once gives a consistent end point without locking. Reads are at
+        most save_steps rows, leaving the ring's margin rows between the start of
+        the copy and the row being written.
+        """
+        if index is None:
+            index = self.save_index
+        start = index - rows
+        if start >= 0:
+            return self.save_buffer[start:index].copy()
+        return np.vstack((self.save_buffer[start:], self.save_buffer[:index]))
+
+    def schedule_update(self):
+        # Keep at most one update_plot pending so stalls cannot pile up callbacks
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+        self.after_id = self.root.after(self.update_interval, self.update_plot)
 
-        with self.lock:
-            if self.avg_index == 0:
-                avg_data = self.avg_buffer.copy()
-            else:
-                avg_data = np.vstack((self.avg_buffer[self.avg_index:, :], self.avg_buffer[:self.avg_index, :]))
-            avg_spectrum = np.mean(avg_data, axis=0)
-            peak_freq = self.freqs[np.argmax(avg_spectrum)]
-            self.avg_label.config(text=f"Avg Frequency (30s): {peak_freq:.2f} Hz")
+    def update_plot(self):
+        if not self.running:
+            return
+
+        if self.samples_written == 0:
+            self.schedule_update()
+            return
 
-        self.root.after(self.update_interval, self.update_plot)
+        # Read save_index once so the image and its colour limits cover the same rows
+        index = self.save_index
+        data_to_plot = self.tail(self.live_steps, index)
+        rows = np.arange(index - self.live_steps, index)
+        vmin = self.row_min.take(rows, mode='wrap').min()
+        vmax = self.row_max.take(rows, mode='wrap').max()
+
+        data_to_plot = self.decimate(data_to_plot)
+        self.im.set_data(data_to_plot.T)
+        self.im.set_clim(vmin=vmin, vmax=vmax)
+        self.canvas.draw_idle()
+
+        peak_freq = self.freqs[np.argmax(self.avg_sum)]
+        self.avg_label.config(text=f"Avg Frequency (30s): {peak_freq:.2f} Hz")
+
+        self.schedule_update()
 
     def auto_save(self):
-        while self.running:
-            time.sleep(60)
-            if self.running:
-                self.save_outputs()
+        # This thread owns the HDF5 stream file for the whole observation
+        h5_name = datetime.now().strftime("Udaipur_PRL_%d%m%Y_%H%M%S") + f"_Fs{self.fs}_N{self.n}.h5"
+        with h5py.File(h5_name, "w") as h5:
+            h5.attrs["FS"] = self.fs
+            h5.attrs["NFFT"] = self.n
+            h5.attrs["INTERVAL"] = self.data_interval
+            h5.create_dataset("FREQ", data=self.freqs)
+            h5.create_dataset("DATA", shape=(0, self.nbins), maxshape=(None, self.nbins),
+                              chunks=(256, self.nbins), dtype="f4", compression="lzf")
+            # Rows overwritten in the ring before they were streamed: the total,
+            # and one (DATA row the gap precedes, rows lost) pair per gap
+            h5.attrs["LOST_ROWS"] = 0
+            h5.create_dataset("GAPS", shape=(0, 2), maxshape=(None, 2), dtype="i8")
+            while not self.stop_event.is_set():
+                self.stream_event.wait(self.stream_interval)
+                self.stream_event.clear()
+                self.append_stream(h5)
+            self.append_stream(h5)
+        print(f"Saved HDF5: {h5_name}")
+
+    def append_stream(self, h5):
+        """Append the samples generated since stream_rows to DATA, recording any already overwritten."""
+        written = self.samples_written
+        pending = written - self.stream_rows
+        rows = min(pending, self.save_steps)
+        ds = h5["DATA"]
+        lost = pending - rows
+        if lost:
+            print(f"HDF5 stream lost {lost} rows: overwritten in the ring before they were written")
+            h5.attrs["LOST_ROWS"] += lost
+            gaps = h5["GAPS"]
+            gaps.resize(len(gaps) + 1, axis=0)
+            gaps[-1] = (ds.shape[0], lost)
+        if rows:
+            ds.resize(ds.shape[0] + rows, axis=0)
+            ds[-rows:] = self.tail(rows, written % self.ring_steps)
+        self.stream_rows = written
 
     def save_outputs(self):
-        with self.lock:
-            if np.all(self.save_buffer == 0):
-                return
-
-            if self.save_index == 0:
-                data_60s = self.save_buffer.copy()
-            else:
-                data_60s = np.vstack((self.save_buffer[self.save_index:, :], self.save_buffer[:self.save_index, :]))
+        if self.samples_written == 0:
+            return
 
+        data_60s = self.tail(self.save_steps)
         rel_times_60s = np.linspace(-self.save_duration, 0, self.save_steps)
-        base_name = datetime.now().strftime("Udaipur_PRL_%d%m%Y_%H%M%S") + f"_Fs{self.fs}_N{self.n}"
+        try:
+            self.write_queue.put_nowait((datetime.now(), rel_times_60s, data_60s, self.fs, self.n, self.freqs, self.cmap))
+        except queue.Full:
+            # Never block the Tk thread on disk; drop this snapshot instead
+            print("Save skipped: previous snapshots are still being written")
+            messagebox.showwarning("Save Skipped", "Previous snapshots are still being written; this one was not saved.")
+
+    def write_worker(self):
+        while True:
+            job = self.write_queue.get()
+            if job is None:
+                break
+            try:
+                self.write_outputs(*job)
+            except Exception as e:
+                print("Save error:", e)
+
+    def write_outputs(self, captured, rel_times_60s, data_60s, fs, n, freqs, cmap):
+        base_name = captured.strftime("Udaipur_PRL_%d%m%Y_%H%M%S") + f"_Fs{fs}_N{n}"
         fits_name = base_name + ".fits"
         png_name = base_name + ".png"
 
-        hdu_time = fits.PrimaryHDU(rel_times_60s)
-        hdu_time.header['FS'] = self.fs
-        hdu_time.header['NFFT'] = self.n
-        hdu_freq = fits.ImageHDU(self.freqs, name="FREQ")
-        hdu_data = fits.ImageHDU(data_60s, name="DATA")
-        fits.HDUList([hdu_time, hdu_freq, hdu_data]).writeto(fits_name, overwrite=True)
+        # Build the file in memory, then write it to its destination in one
+        # sequential write instead of cfitsio's many small ones.
+        with fitsio.FITS('mem://', 'rw') as f:
+            f.write(rel_times_60s, header={'FS': fs, 'NFFT': n})
+            f.write(freqs, extname="FREQ")
+            f.write(data_60s, extname="DATA", compress="RICE", tile_dims=[1, data_60s.shape[1]],
+                    qlevel=self.fits_qlevel, qmethod=self.fits_qmethod)
+            raw = f.read_raw()
+        with open(fits_name, 'wb') as out:
+            out.write(raw)
         print(f"Saved FITS: {fits_name}")
 
-        fig, ax = plt.subplots(figsize=(12, 5))
-        extent = [rel_times_60s[0], rel_times_60s[-1], 0, self.fs / 2]
-        im = ax.imshow(data_60s.T, aspect='auto', extent=extent, origin='lower', cmap=self.cmap_var.get())
-        ax.set_title(f"60s Spectrogram Snapshot  (Fs={self.fs} Hz, N={self.n})")
+        fig = self.save_fig
+        fig.clear()
+        ax = fig.add_subplot(111)
+        extent = [rel_times_60s[0], rel_times_60s[-1], 0, fs / 2]
+        im = ax.imshow(data_60s.T, aspect='auto', extent=extent, origin='lower', cmap=cmap)
+        ax.set_title(f"60s Spectrogram Snapshot  (Fs={fs} Hz, N={n})")
         ax.set_xlabel("Time (s)")
         ax.set_ylabel("Frequency (Hz)")
-        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now_str = captured.strftime("%Y-%m-%d %H:%M:%S")
         ax.text(0.5, -0.15, f"Captured at: {now_str}", ha='center', va='top', transform=ax.transAxes, fontsize=10)
         fig.colorbar(im, ax=ax, label="Intensity")
-        plt.tight_layout()
-        plt.savefig(png_name, bbox_inches='tight')
-        plt.close(fig)
+        fig.tight_layout()
+        fig.savefig(png_name, bbox_inches='tight')
         print(f"Saved PNG: {png_name}")
 
     def stop_observation(self):
         self.running = False
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
         self.start_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
+        # Retire the producer and flush the last rows to the HDF5 stream before a
+        # restart can replace the buffers and counters
+        self.stop_event.set()
+        self.stream_event.set()
+        self.data_thread.join()
+        self.save_thread.join()
         self.save_outputs()
 
     def close_app(self):
         if self.running:
             self.stop_observation()
+        # Let queued snapshots finish writing before the process exits
+        self.write_queue.put(None)
+        self.writer_thread.join()
         self.root.quit()
         self.root.destroy()
 
@@ -2,11 +2,15 @@ import tkinter as tk
 from tkinter import messagebox
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from datetime import datetime
 import threading
 import time
-from astropy.io import fits
+import queue
+import fitsio
+import h5py
 import socket
 
 
@@ -51,12 +55,38 @@ class SpectrogramApp:
         for i in range(3):
             root.grid_columnconfigure(i, weight=1)
 
+        # Off-screen figure reused for every PNG snapshot, kept away from pyplot
+        self.save_fig = Figure(figsize=(10, 4))
+        self.save_canvas = FigureCanvasAgg(self.save_fig)
+
+        # RICE quantization of the FITS DATA HDU: each tile (one spectrum) is
+        # quantized in steps of its noise sigma / fits_qlevel. At 16 the RMS error
+        # is under 1% of the data's spread (about 3.5% at cfitsio's default of 4).
+        # SUBTRACTIVE_DITHER_2 dithers the steps but keeps exact zeros.
+        self.fits_qlevel = 16.0
+        self.fits_qmethod = 'SUBTRACTIVE_DITHER_2'
+
+        # Disk writes run on their own thread; save_outputs only snapshots
+        self.write_queue = queue.Queue(maxsize=2)
+        self.writer_thread = threading.Thread(target=self.write_worker, daemon=True)
+        self.writer_thread.start()
+
+        self.im = None
+        self.after_id = None
         self.colorbar = None
+        self.plot_rows = 800
         self.running = False
         self.paused = False
-        self.lock = threading.Lock()
-        self.data = []
-        self.timestamps = []
+        self.live_duration = 10
+        self.update_interval = 100
+        # Most frames one recv can deliver; readers stay this far behind the producer
+        self.burst = 64
+        # Upper bound on ring memory; past it, frames still inside the window are dropped
+        self.max_ring_bytes = 512 * 2**20
+        # HDF5 appends run at least this often; push_frames also wakes auto_save
+        # once half the ring is waiting to be streamed
+        self.stream_interval = self.live_duration / 2
+        self.save_thread = None
 
     def start_observation(self):
         try:
@@ -68,18 +98,46 @@ class SpectrogramApp:
             messagebox.showerror("Invalid Input", "Please enter valid integers for Fs, N, and Port.")
             return
 
-        self.freqs = np.linspace(0, self.fs / 2, self.n)
+        # Frames arrive as spectra already computed by the receiver: N bins
+        # spanning 0 to Fs/2, so no FFT is done here
+        self.freqs = np.linspace(0, self.fs / 2, self.n, dtype=np.float32)
+
+        # Ring of the last live_duration seconds of frames: (timestamps, frames,
+        # per-frame min, per-frame max). It starts sized for one frame per N
+        # samples at Fs, within max_ring_bytes, and push_frames doubles it when
+        # a sender is faster. Frame number p lives in slot p % capacity; slots
+        # never written hold timestamp -inf, older than any window.
+        capacity = int(self.live_duration * self.fs / self.n) + self.burst
+        capacity = max(2 * self.burst, min(capacity, self.max_ring_bytes // (4 * self.n + 16)))
+        self.rings = (np.full(capacity, -np.inf),
+                      np.empty((capacity, self.n), dtype=np.float32),
+                      np.empty(capacity, dtype=np.float32),
+                      np.empty(capacity, dtype=np.float32))
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.reported_dropped = 0
+        # Frames already appended to the HDF5 stream
+        self.stream_rows = 0
+
+        # Frames are binned onto a fixed 50 ms display grid
+        self.num_steps = int(self.live_duration / 0.05)
+        self.full_times = np.linspace(-self.live_duration, 0, self.num_steps)
+        self.aligned = np.full((self.num_steps, self.n), np.nan, dtype=np.float32)
+        # Frequency bins folded into each displayed row
+        self.ydec = max(1, self.n // self.plot_rows)
+        self.setup_plot()
+
         self.running = True
         self.paused = False
-        self.data = []
-        self.timestamps = []
-
         self.start_button.config(state=tk.DISABLED)
         self.pause_button.config(state=tk.NORMAL)
         self.save_button.config(state=tk.NORMAL)
 
+        self.stop_event = threading.Event()
+        self.stream_event = threading.Event()
         threading.Thread(target=self.receive_data_tcp, daemon=True).start()
-        threading.Thread(target=self.auto_save, daemon=True).start()
+        self.save_thread = threading.Thread(target=self.auto_save, daemon=True)
+        self.save_thread.start()
         self.update_plot()
 
     def toggle_pause(self):
@@ -94,27 +152,31 @@ class SpectrogramApp:
         conn, addr = sock.accept()
         print(f"Connected to {addr}")
 
-        buffer = b''
+        # Fixed receive buffer; bytes [0, filled) hold data not yet parsed
+        frame_bytes = self.n * 4
+        buffer = bytearray(self.burst * frame_bytes)
+        view = memoryview(buffer)
+        filled = 0
         while self.running:
             if self.paused:
                 time.sleep(0.1)
                 continue
 
             try:
-                buffer += conn.recv(4096)
-                while len(buffer) >= self.n * 4:
-                    sample = np.frombuffer(buffer[:self.n * 4], dtype=np.float32)
-                    buffer = buffer[self.n * 4:]
-
-                    with self.lock:
-                        self.data.append(sample)
-                        self.timestamps.append(time.time())
-
-                        # Keep only the last 10 seconds
-                        cutoff = time.time() - 10
-                        while self.timestamps and self.timestamps[0] < cutoff:
-                            self.timestamps.pop(0)
-                            self.data.pop(0)
+                got = conn.recv_into(view[filled:])
+                if got == 0:
+                    print("TCP connection closed")
+                    break
+                filled += got
+                # Parse every complete frame in the buffer at once
+                k = filled // frame_bytes
+                if k:
+                    block = np.frombuffer(buffer, dtype=np.float32, count=k * self.n).reshape(k, self.n)
+                    self.push_frames(block, time.time())
+                    # Move the partial frame, if any, back to the start
+                    used = k * frame_bytes
+                    view[:filled - used] = view[used:filled]
+                    filled -= used
             except Exception as e:
                 print("TCP read error:", e)
                 break
@@ -122,38 +184,81 @@ class SpectrogramApp:
         conn.close()
         sock.close()
 
-    def update_plot(self):
-        if not self.running:
-            return
-        if self.paused:
-            self.root.after(100, self.update_plot)
-            return
-
-        current_time = time.time()
-
-        with self.lock:
-            if len(self.data) == 0:
-                self.root.after(100, self.update_plot)
-                return
-
-            times = np.array(self.timestamps)
-            rel_times = times - current_time  # -10 to 0
-            data_array = np.array(self.data)
-
-        duration = 10
-        num_steps = int(duration / 0.05)
-        full_times = np.linspace(-10, 0, num_steps)
-        aligned_data = np.full((num_steps, self.n), np.nan)
-
-        for t, d in zip(rel_times, data_array):
-            idx = np.searchsorted(full_times, t)
-            if 0 <= idx < num_steps:
-                aligned_data[idx] = d
-
-        extent = [-10, 0, 0, self.fs / 2]
+    def push_frames(self, block, now):
+        """Copy a (k, N) block of frames into the ring, growing it if the window would not fit."""
+        # Single producer: store the frames first, then publish them.
+        # Frames older than 10 seconds are dropped by snapshot().
+        k = len(block)
+        written = self.frames_written
+        rings = self.rings
+        cutoff = now - self.live_duration
+        while True:
+            capacity = len(rings[0])
+            # Stored frames before `needed` are overwritten by this block or left
+            # within one burst of the next write, where readers no longer trust them
+            oldest = written - min(written, capacity)
+            needed = written + k + self.burst - capacity
+            if needed <= oldest or rings[0][(needed - 1) % capacity] < cutoff:
+                break
+            if 2 * capacity * (rings[1].itemsize * self.n + 16) > self.max_ring_bytes:
+                overwritten = np.arange(oldest, written + k - capacity) % capacity
+                self.frames_dropped += int(np.count_nonzero(rings[0][overwritten] >= cutoff))
+                break
+            rings = self.grow_rings(rings, written)
+
+        capacity = len(rings[0])
+        keep = min(k, capacity)
+        start = (written + k - keep) % capacity
+        first = min(keep, capacity - start)
+        block = block[k - keep:]
+        # Extrema of each frame as decimate() draws it, so the colour limits match the image
+        shown = self.decimate(block)
+        lo = shown.min(axis=1)
+        hi = shown.max(axis=1)
+        for ring, values in zip(rings, (now, block, lo, hi)):
+            if np.ndim(values):
+                ring[start:start + first] = values[:first]
+                ring[:keep - first] = values[first:]
+            else:
+                ring[start:start + first] = values
+                ring[:keep - first] = values
+        self.frames_written = written + k
+        # Wake auto_save well before unstreamed frames reach the write position
+        if written + k - self.stream_rows >= (capacity - self.burst) // 2:
+            self.stream_event.set()
+
+    def grow_rings(self, rings, written):
+        """Publish copies of the rings at twice the capacity, keeping every stored frame."""
+        capacity = len(rings[0])
+        positions = np.arange(written - min(written, capacity), written)
+        grown = []
+        for ring in rings:
+            new = np.empty((2 * capacity,) + ring.shape[1:], dtype=ring.dtype)
+            if ring is rings[0]:
+                new.fill(-np.inf)
+            new[positions % (2 * capacity)] = ring[positions % capacity]
+            grown.append(new)
+        # Readers holding the old tuple keep a consistent copy; nothing writes to it again
+        self.rings = tuple(grown)
+        print(f"Frame ring grown to {2 * capacity} frames")
+        return self.rings
+
+    def decimate(self, data):
+        """Block-max the frequency axis down to about plot_rows bins, keeping peaks visible."""
+        if self.ydec == 1:
+            return data
+        rows = self.n // self.ydec
+        return data[:, :rows * self.ydec].reshape(len(data), rows, self.ydec).max(axis=-1)
+
+    def setup_plot(self):
+        # Create the image and colorbar once; update_plot only swaps pixel data.
+        # decimate() drops the top N % ydec bins, so the image ends just below Fs/2
+        rows = self.n // self.ydec
+        top = self.fs / 2 * rows * self.ydec / self.n
+        extent = [-10, 0, 0, top]
         self.ax.clear()
-        im = self.ax.imshow(
-            aligned_data.T,
+        self.im = self.ax.imshow(
+            np.zeros((rows, self.num_steps), dtype=np.float32),
             aspect='auto',
             extent=extent,
             origin='lower',
@@ -164,57 +269,228 @@ class SpectrogramApp:
         self.ax.set_xlabel("Time (s)")
         self.ax.set_ylabel("Frequency (Hz)")
         self.ax.set_xlim(-10, 0)
-        self.ax.set_ylim(0, self.fs / 2)
+        self.ax.set_ylim(0, top)
 
         if self.colorbar is None:
-            self.colorbar = self.fig.colorbar(im, ax=self.ax, label="Intensity")
+            self.colorbar = self.fig.colorbar(self.im, ax=self.ax, label="Intensity")
+        else:
+            self.colorbar.update_normal(self.im)
+        self.canvas.draw_idle()
+
+    def unwrap(self, written, rows):
+        """Return (timestamps, frames, row_min, row_max) for up to `rows` frames ending at frame count `written`, oldest first.
+
+        Frames the receiver may have been overwriting during the copy are left out,
+        so fewer than `rows` frames can come back.
+        """
+        # Read the rings after `written`: a grow in between has already copied every frame before it
+        rings = self.rings
+        capacity = len(rings[0])
+        rows = min(rows, written, capacity - self.burst)
+        head = written % capacity
+        start = head - rows
+        if start >= 0:
+            out = [ring[start:head].copy() for ring in rings]
         else:
-            im.set_clim(vmin=np.nanmin(aligned_data), vmax=np.nanmax(aligned_data))
-            self.colorbar.update_normal(im)
+            out = [np.concatenate((ring[start:], ring[:head])) for ring in rings]
+        # The receiver writes at most one burst past frames_written, so any frame
+        # older than that, less one ring, may be torn
+        skip = max(0, self.frames_written + self.burst - capacity - (written - rows))
+        return [a[skip:] for a in out]
+
+    def snapshot(self):
+        """Return (timestamps, frames, row_min, row_max) from the last 10 seconds of the stream, oldest first.
+
+        frames_written is only advanced by receive_data_tcp after the frame is
+        stored, so reading it once gives a consistent end point without locking;
+        unwrap() keeps the start of the copy clear of the frames being written.
+        """
+        written = self.frames_written
+        if written == 0:
+            return tuple(self.unwrap(0, 0))
+        ts = self.rings[0]
+        capacity = len(ts)
+        rows = min(written, capacity - self.burst)
+        head = written % capacity
+        cutoff = ts[(written - 1) % capacity] - self.live_duration
+        # Find the window's first frame in the timestamp ring itself, one sorted
+        # run at a time, so frames older than the window are never copied
+        start = head - rows
+        if start >= 0:
+            rows -= np.searchsorted(ts[start:head], cutoff)
+        else:
+            older = ts[start:]
+            old_rows = np.searchsorted(older, cutoff)
+            if old_rows == len(older):
+                old_rows += np.searchsorted(ts[:head], cutoff)
+            rows -= old_rows
+        out = self.unwrap(written, rows)
+        # A timestamp overwritten during the search can only widen the window; trim the copy exactly
+        keep = np.searchsorted(out[0], cutoff)
+        return tuple(a[keep:] for a in out)
+
+    def schedule_update(self):
+        # Keep at most one update_plot pending so stalls cannot pile up callbacks
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+        self.after_id = self.root.after(self.update_interval, self.update_plot)
+
+    def update_plot(self):
+        if not self.running:
+            return
+        if self.paused:
+            self.schedule_update()
+            return
 
-        self.canvas.draw()
-        self.root.after(100, self.update_plot)
+        current_time = time.time()
+
+        if self.frames_written == 0:
+            self.schedule_update()
+            return
+
+        times, data_array, row_min, row_max = self.snapshot()
+        if len(times) == 0:
+            self.schedule_update()
+            return
+        rel_times = times - current_time  # -10 to 0
+
+        if self.frames_dropped != self.reported_dropped:
+            print(f"Dropped {self.frames_dropped - self.reported_dropped} frames from the live window "
+                  f"({self.frames_dropped} total): sender is faster than the frame ring can hold")
+            self.reported_dropped = self.frames_dropped
+            self.ax.set_title(f"Live Spectrogram (Last 10s) - Fs: {self.fs} Hz, N: {self.n} "
+                              f"- {self.frames_dropped} frames dropped")
+
+        num_steps = self.num_steps
+        full_times = self.full_times
+        aligned_data = self.aligned
+        aligned_data.fill(np.nan)
+
+        idx = np.searchsorted(full_times, rel_times)
+        # Only the newest frame in each 50 ms column is drawn, and only it sets the colour limits
+        mask = idx < num_steps
+        mask[:-1] &= idx[:-1] != idx[1:]
+        aligned_data[idx[mask]] = data_array[mask]
+
+        aligned_data = self.decimate(aligned_data)
+        self.im.set_data(aligned_data.T)
+        if mask.any():
+            self.im.set_clim(vmin=row_min[mask].min(), vmax=row_max[mask].max())
+        self.canvas.draw_idle()
+        self.schedule_update()
 
     def auto_save(self):
-        while self.running:
-            time.sleep(60)
-            if self.running and not self.paused:
-                self.save_outputs()
+        # This thread owns the HDF5 stream file for the whole observation
+        h5_name = datetime.now().strftime("Udaipur_PRL_%d%m%Y_%H%M%S") + f"_Fs{self.fs}_N{self.n}.h5"
+        with h5py.File(h5_name, "w") as h5:
+            h5.attrs["FS"] = self.fs
+            h5.attrs["NFFT"] = self.n
+            h5.create_dataset("FREQ", data=self.freqs)
+            h5.create_dataset("TIME", shape=(0,), maxshape=(None,), chunks=(256,), dtype="f8")
+            h5.create_dataset("DATA", shape=(0, self.n), maxshape=(None, self.n),
+                              chunks=(256, self.n), dtype="f4", compression="lzf")
+            # Frames overwritten in the ring before they were streamed: the total,
+            # and one (DATA row the gap precedes, frames lost) pair per gap
+            h5.attrs["LOST_FRAMES"] = 0
+            h5.create_dataset("GAPS", shape=(0, 2), maxshape=(None, 2), dtype="i8")
+            while not self.stop_event.is_set():
+                self.stream_event.wait(self.stream_interval)
+                self.stream_event.clear()
+                self.append_stream(h5)
+            self.append_stream(h5)
+        print(f"Saved HDF5: {h5_name}")
+
+    def append_stream(self, h5):
+        """Append the frames received since stream_rows to the TIME/DATA datasets, recording any already overwritten."""
+        written = self.frames_written
+        pending = written - self.stream_rows
+        times, frames, _, _ = self.unwrap(written, pending)
+        # Slots a grow left unwritten come first; they were lost, not received
+        first = np.searchsorted(times, -np.inf, side='right')
+        times, frames = times[first:], frames[first:]
+        rows = len(times)
+        ds_time, ds_data = h5["TIME"], h5["DATA"]
+        lost = pending - rows
+        if lost:
+            print(f"HDF5 stream lost {lost} frames: overwritten in the ring before they were written")
+            h5.attrs["LOST_FRAMES"] += lost
+            gaps = h5["GAPS"]
+            gaps.resize(len(gaps) + 1, axis=0)
+            gaps[-1] = (ds_time.shape[0], lost)
+        if rows:
+            ds_time.resize(ds_time.shape[0] + rows, axis=0)
+            ds_time[-rows:] = times
+            ds_data.resize(ds_data.shape[0] + rows, axis=0)
+            ds_data[-rows:] = frames
+        self.stream_rows = written
 
     def save_outputs(self):
-        with self.lock:
-            if not self.data:
-                return
-            rel_times = np.array(self.timestamps) - self.timestamps[-1]
-            data_array = np.array(self.data)
+        if self.frames_written == 0:
+            return
+        times, data_array, _, _ = self.snapshot()
+        if len(times) == 0:
+            return
+        rel_times = times - times[-1]
+        try:
+            self.write_queue.put_nowait((datetime.now(), rel_times, data_array, self.fs, self.n, self.freqs))
+        except queue.Full:
+            # Never block the Tk thread on disk; drop this snapshot instead
+            print("Save skipped: previous snapshots are still being written")
+            messagebox.showwarning("Save Skipped", "Previous snapshots are still being written; this one was not saved.")
+
+    def write_worker(self):
+        while True:
+            job = self.write_queue.get()
+            if job is None:
+                break
+            try:
+                self.write_outputs(*job)
+            except Exception as e:
+                print("Save error:", e)
 
-        base_name = datetime.now().strftime("Udaipur_PRL_%d%m%Y_%H%M%S") + f"_Fs{self.fs}_N{self.n}"
+    def write_outputs(self, captured, rel_times, data_array, fs, n, freqs):
+        base_name = captured.strftime("Udaipur_PRL_%d%m%Y_%H%M%S") + f"_Fs{fs}_N{n}"
         fits_name = base_name + ".fits"
         png_name = base_name + ".png"
 
-        hdu_time = fits.PrimaryHDU(rel_times)
-        hdu_time.header['FS'] = self.fs
-        hdu_time.header['NFFT'] = self.n
-        hdu_freq = fits.ImageHDU(self.freqs, name="FREQ")
-        hdu_data = fits.ImageHDU(data_array, name="DATA")
-        fits.HDUList([hdu_time, hdu_freq, hdu_data]).writeto(fits_name, overwrite=True)
+        # Build the file in memory, then write it to its destination in one
+        # sequential write instead of cfitsio's many small ones.
+        with fitsio.FITS('mem://', 'rw') as f:
+            f.write(rel_times, header={'FS': fs, 'NFFT': n})
+            f.write(freqs, extname="FREQ")
+            f.write(data_array, extname="DATA", compress="RICE", tile_dims=[1, n],
+                    qlevel=self.fits_qlevel, qmethod=self.fits_qmethod)
+            raw = f.read_raw()
+        with open(fits_name, 'wb') as out:
+            out.write(raw)
         print(f"Saved FITS: {fits_name}")
 
-        fig, ax = plt.subplots(figsize=(10, 4))
-        extent = [rel_times[0], rel_times[-1], 0, self.fs / 2]
+        fig = self.save_fig
+        fig.clear()
+        ax = fig.add_subplot(111)
+        extent = [rel_times[0], rel_times[-1], 0, fs / 2]
         im = ax.imshow(data_array.T, aspect='auto', extent=extent, origin='lower', cmap='nipy_spectral')
-        ax.set_title(f"60s Spectrogram Snapshot - Fs: {self.fs} Hz, N: {self.n}")
-        ax.set_xlabel("Time (s)\n" + datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        ax.set_title(f"60s Spectrogram Snapshot - Fs: {fs} Hz, N: {n}")
+        ax.set_xlabel("Time (s)\n" + captured.strftime("%Y-%m-%d %H:%M:%S"))
         ax.set_ylabel("Frequency (Hz)")
         fig.colorbar(im, ax=ax, label="Intensity")
-        plt.tight_layout()
-        plt.savefig(png_name)
-        plt.close()
+        fig.tight_layout()
+        fig.savefig(png_name)
         print(f"Saved PNG: {png_name}")
 
     def close_app(self):
         if self.running:
             self.running = False
+            if self.after_id is not None:
+                self.root.after_cancel(self.after_id)
+                self.after_id = None
+        # Let the HDF5 stream and queued snapshots finish writing before the process exits
+        if self.save_thread is not None:
+            self.stop_event.set()
+            self.stream_event.set()
+            self.save_thread.join()
+        self.write_queue.put(None)
+        self.writer_thread.join()
         self.root.quit()
         self.root.destroy()
 